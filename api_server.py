@@ -6,14 +6,20 @@ FastAPI сервер для интеграции с React frontend
 
 import asyncio
 import json
+import logging
 import os
+import time
+import traceback
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, validator
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+import orjson
 import uvicorn
 
 # Импорты из существующего кода
@@ -21,14 +27,34 @@ from sensitive_entities import (
     mask_with_catalog_then_llm,
     demask_text,
     add_sensitive_entity,
-    _load_catalog,
+    update_sensitive_entity as update_catalog_entity,
+    delete_sensitive_entity as delete_catalog_entity,
+    _catalog_snapshot,
 )
-from openrouter_api import get_answer as openrouter_get_answer
+from openrouter_api import get_answer as openrouter_get_answer, stream_answer as openrouter_stream_answer
+from ollama_api import _get_session as ollama_get_session, close_session as ollama_close_session
+
+# Логирование настраивается здесь, в модуле приложения, а не в библиотечных модулях:
+# воркеры uvicorn импортируют api_server, минуя блок __main__. Предупреждения, выводимые
+# модулями проекта при импорте, до настройки уходят в stderr через logging.lastResort
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Открывает общую HTTP-сессию к Ollama при запуске и закрывает её при остановке"""
+    await ollama_get_session()
+    try:
+        yield
+    finally:
+        await ollama_close_session()
 
 app = FastAPI(
     title="Safe Dialog API",
     description="API для маскирования чувствительных данных",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # CORS настройки для React приложения
@@ -40,13 +66,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Сжатие ответов (маскированный текст, список сущностей) при поддержке клиентом; мелкие ответы не сжимаем
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
+
 # Pydantic модели для API
 class TextMaskingRequest(BaseModel):
+    # Маскирование не зависит от системного промпта: присланный frontend systemPrompt игнорируется
     text: str
-    system_prompt: Optional[str] = None
 
-    @validator('text')
-    def text_must_not_be_empty(cls, v):
+    @field_validator('text')
+    @classmethod
+    def text_must_not_be_empty(cls, v: str) -> str:
         if not v.strip():
             raise ValueError('Текст не может быть пустым')
         return v
@@ -57,39 +87,26 @@ class TextMaskingResponse(BaseModel):
     processing_time: Optional[float] = None
 
 class TextProcessingRequest(BaseModel):
+    # Разрешаем дополнительные поля и принимаем как system_prompt, так и camelCase systemPrompt от frontend
+    model_config = ConfigDict(extra="allow", populate_by_name=True)
+
     text: str
-    system_prompt: Optional[str] = None
-    
-    # Поддержка camelCase для совместимости с frontend
-    @validator('system_prompt', pre=True, always=True)
-    def convert_system_prompt(cls, v, values):
-        # Если system_prompt не указан, но есть в values под другим именем
-        if v is None and hasattr(cls, '_camel_case_data'):
-            return cls._camel_case_data.get('systemPrompt')
-        return v
-    
-    class Config:
-        # Разрешаем дополнительные поля для совместимости
-        extra = "allow"
-        
-    def __init__(self, **data):
-        # Сохраняем оригинальные данные для конвертации
-        if 'systemPrompt' in data and 'system_prompt' not in data:
-            data['system_prompt'] = data['systemPrompt']
-        super().__init__(**data)
+    system_prompt: Optional[str] = Field(default=None, alias="systemPrompt")
 
 class SensitiveEntityCreate(BaseModel):
     name: str
     placeholder: str
 
-    @validator('name')
-    def name_must_not_be_empty(cls, v):
+    @field_validator('name')
+    @classmethod
+    def name_must_not_be_empty(cls, v: str) -> str:
         if not v.strip():
             raise ValueError('Название не может быть пустым')
         return v.strip()
 
-    @validator('placeholder')
-    def placeholder_must_not_be_empty(cls, v):
+    @field_validator('placeholder')
+    @classmethod
+    def placeholder_must_not_be_empty(cls, v: str) -> str:
         if not v.strip():
             raise ValueError('Заменитель не может быть пустым')
         return v.strip()
@@ -108,21 +125,53 @@ class HealthResponse(BaseModel):
     version: str
 
 # Утилиты
+SYSTEM_PROMPT_FILE = 'DefaultSystemPrompt.txt'
+DEFAULT_SYSTEM_PROMPT = 'Ты — вежливый и дружелюбный ассистент. Приводи чётко структурированный ответ.'
+
+# Кэш системного промпта: (mtime_ns файла, содержимое)
+_system_prompt_cache: Optional[Tuple[int, str]] = None
+
 def load_system_prompt() -> str:
-    """Загружает системный промпт из файла"""
+    """Загружает системный промпт из файла (с кэшированием по mtime)"""
+    global _system_prompt_cache
     try:
-        with open('DefaultSystemPrompt.txt', 'r', encoding='utf-8') as f:
+        mtime = os.stat(SYSTEM_PROMPT_FILE).st_mtime_ns
+        if _system_prompt_cache is not None and _system_prompt_cache[0] == mtime:
+            return _system_prompt_cache[1] or DEFAULT_SYSTEM_PROMPT
+        with open(SYSTEM_PROMPT_FILE, 'r', encoding='utf-8') as f:
             content = f.read().strip()
-            if content:
-                return content
+        _system_prompt_cache = (mtime, content)
+        if content:
+            return content
     except (FileNotFoundError, IOError):
         pass
-    return 'Ты — вежливый и дружелюбный ассистент. Приводи чётко структурированный ответ.'
+    return DEFAULT_SYSTEM_PROMPT
 
 def save_system_prompt(prompt: str) -> None:
     """Сохраняет системный промпт в файл"""
-    with open('DefaultSystemPrompt.txt', 'w', encoding='utf-8') as f:
+    global _system_prompt_cache
+    with open(SYSTEM_PROMPT_FILE, 'w', encoding='utf-8') as f:
         f.write(prompt)
+    _system_prompt_cache = (os.stat(SYSTEM_PROMPT_FILE).st_mtime_ns, prompt.strip())
+
+# Список сущностей каталога и его JSON-представление; пересобираются только при смене версии каталога.
+# Хранятся одним кортежем (каталог, список, JSON) и заменяются целиком: load_entities вызывается
+# из пула потоков, и читатель не должен получить список от одной версии каталога, а JSON от другой
+_entities_cache: Optional[Tuple[Dict[str, Dict[str, str]], List[Dict[str, str]], bytes]] = None
+
+def load_entities() -> Tuple[List[Dict[str, str]], bytes]:
+    """Возвращает список сущностей каталога и тот же список, сериализованный в JSON"""
+    global _entities_cache
+    catalog = _catalog_snapshot()
+    cached = _entities_cache
+    if cached is None or cached[0] is not catalog:
+        items = [
+            {"id": entity_id, "name": entity["name"], "placeholder": entity["placeholder"]}
+            for entity_id, entity in catalog.items()
+        ]
+        cached = (catalog, items, orjson.dumps(items))
+        _entities_cache = cached
+    return cached[1], cached[2]
 
 # API endpoints
 @app.get("/api/health", response_model=HealthResponse)
@@ -134,39 +183,32 @@ async def health_check():
         version="1.0.0"
     )
 
-@app.post("/api/mask-text", response_model=TextMaskingResponse)
+@app.post("/api/mask-text", responses={200: {"model": TextMaskingResponse}})
 async def mask_text(request: TextMaskingRequest):
     """Маскирование чувствительных данных в тексте"""
     try:
-        import time
-        import logging
-        
         start_time = time.time()
         text_length = len(request.text)
         
-        logging.info(f"Начало маскирования текста длиной {text_length} символов")
+        logger.info("Начало маскирования текста длиной %d символов", text_length)
         
         masked_text = await mask_with_catalog_then_llm(request.text)
         
         processing_time = time.time() - start_time
-        logging.info(f"Маскирование завершено за {processing_time:.2f} секунд")
+        logger.info("Маскирование завершено за %.2f секунд", processing_time)
         
-        # Получаем информацию о найденных сущностях
-        catalog = _load_catalog()
-        entities_found = [
-            {"id": entity_id, "name": entity["name"], "placeholder": entity["placeholder"]}
-            for entity_id, entity in catalog.items()
-        ]
+        # Получаем информацию о найденных сущностях. Каталог читаем после маскирования, а не
+        # параллельно с ним: LLM-этап может добавить новые записи, и они должны попасть в ответ
+        entities_found, _ = await asyncio.to_thread(load_entities)
         
-        return TextMaskingResponse(
-            masked_text=masked_text,
-            entities_found=entities_found,
-            processing_time=processing_time
-        )
+        return ORJSONResponse({
+            "masked_text": masked_text,
+            "entities_found": entities_found,
+            "processing_time": processing_time,
+        })
     except Exception as e:
-        import traceback
-        logging.error(f"Ошибка маскирования: {str(e)}")
-        logging.error(f"Traceback: {traceback.format_exc()}")
+        logger.error("Ошибка маскирования: %s", e)
+        logger.error("Traceback: %s", traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Ошибка маскирования: {str(e)}")
 
 @app.post("/api/demask-text")
@@ -183,43 +225,42 @@ async def demask_text_endpoint(request: dict):
         raise HTTPException(status_code=500, detail=f"Ошибка де-маскирования: {str(e)}")
 
 @app.post("/api/process-openrouter")
-async def process_with_openrouter(request: TextProcessingRequest):
-    """Обработка текста через OpenRouter"""
+async def process_with_openrouter(request: TextProcessingRequest, stream: bool = False):
+    """Обработка текста через OpenRouter (?stream=true — ответ отдаётся по мере генерации)"""
+    if stream:
+        async def body():
+            async for chunk in openrouter_stream_answer(request.text, request.system_prompt):
+                yield chunk.encode("utf-8")
+        # Content-Encoding: identity исключает поток из GZip: иначе фрагменты копились бы в буфере сжатия
+        return StreamingResponse(
+            body(),
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Encoding": "identity"},
+        )
+    
     try:
-        import time
-        import logging
-        
         start_time = time.time()
         text_length = len(request.text)
         
-        logging.info(f"Начало обработки через OpenRouter, текст длиной {text_length} символов")
+        logger.info("Начало обработки через OpenRouter, текст длиной %d символов", text_length)
         
         result = await openrouter_get_answer(request.text, request.system_prompt)
         
         processing_time = time.time() - start_time
-        logging.info(f"Обработка OpenRouter завершена за {processing_time:.2f} секунд")
+        logger.info("Обработка OpenRouter завершена за %.2f секунд", processing_time)
         
         return result  # Возвращаем строку напрямую
     except Exception as e:
-        import traceback
-        logging.error(f"Ошибка обработки через OpenRouter: {str(e)}")
-        logging.error(f"Traceback: {traceback.format_exc()}")
+        logger.error("Ошибка обработки через OpenRouter: %s", e)
+        logger.error("Traceback: %s", traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Ошибка обработки через OpenRouter: {str(e)}")
 
-@app.get("/api/sensitive-entities", response_model=List[SensitiveEntityResponse])
+@app.get("/api/sensitive-entities", responses={200: {"model": List[SensitiveEntityResponse]}})
 async def get_sensitive_entities():
     """Получение списка чувствительных данных"""
     try:
-        catalog = _load_catalog()
-        entities = [
-            SensitiveEntityResponse(
-                id=entity_id,
-                name=entity["name"],
-                placeholder=entity["placeholder"]
-            )
-            for entity_id, entity in catalog.items()
-        ]
-        return entities
+        _, body = await asyncio.to_thread(load_entities)
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка загрузки справочника: {str(e)}")
 
@@ -227,7 +268,7 @@ async def get_sensitive_entities():
 async def create_sensitive_entity(entity: SensitiveEntityCreate):
     """Создание новой записи в справочнике"""
     try:
-        entity_id = add_sensitive_entity(entity.name, entity.placeholder)
+        entity_id = await asyncio.to_thread(add_sensitive_entity, entity.name, entity.placeholder)
         return SensitiveEntityResponse(
             id=entity_id,
             name=entity.name,
@@ -240,20 +281,10 @@ async def create_sensitive_entity(entity: SensitiveEntityCreate):
 async def update_sensitive_entity(entity_id: str, entity: SensitiveEntityCreate):
     """Обновление записи в справочнике"""
     try:
-        catalog = _load_catalog()
-        if entity_id not in catalog:
+        updated = await asyncio.to_thread(update_catalog_entity, entity_id, entity.name, entity.placeholder)
+        if not updated:
             raise HTTPException(status_code=404, detail="Запись не найдена")
         
-        # Обновляем запись
-        catalog[entity_id] = {
-            "name": entity.name,
-            "placeholder": entity.placeholder
-        }
-        
-        # Сохраняем каталог
-        from sensitive_entities import _save_catalog
-        _save_catalog(catalog)
-        
         return SensitiveEntityResponse(
             id=entity_id,
             name=entity.name,
@@ -268,16 +299,10 @@ async def update_sensitive_entity(entity_id: str, entity: SensitiveEntityCreate)
 async def delete_sensitive_entity(entity_id: str):
     """Удаление записи из справочника"""
     try:
-        catalog = _load_catalog()
-        if entity_id not in catalog:
+        deleted = await asyncio.to_thread(delete_catalog_entity, entity_id)
+        if not deleted:
             raise HTTPException(status_code=404, detail="Запись не найдена")
         
-        del catalog[entity_id]
-        
-        # Сохраняем каталог
-        from sensitive_entities import _save_catalog
-        _save_catalog(catalog)
-        
         return {"message": "Запись удалена"}
     except HTTPException:
         raise
@@ -305,23 +330,33 @@ async def update_system_prompt(request: SystemPromptRequest):
 # Error handlers
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=404,
         content={"success": False, "error": "Endpoint not found"}
     )
 
 @app.exception_handler(500)
 async def internal_error_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"success": False, "error": "Internal server error"}
     )
 
 if __name__ == "__main__":
+    # API_RELOAD=true — режим разработки: один процесс с автоперезагрузкой.
+    # Иначе запускаем несколько воркеров (API_WORKERS, по умолчанию по числу ядер).
+    # Кэши каталога, промпта и ответов LLM, а также HTTP-сессии создаются в каждом воркере свои;
+    # каталог между воркерами согласуется через mtime файла и блокировку записи.
+    # uvicorn[standard] устанавливает uvloop и httptools, и uvicorn выбирает их автоматически
+    # (на Windows uvloop недоступен — используется стандартный asyncio).
+    reload = os.getenv("API_RELOAD", "").lower() in ("1", "true", "yes")
     uvicorn.run(
         "api_server:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
+        host=os.getenv("API_HOST", "0.0.0.0"),
+        port=int(os.getenv("API_PORT", "8000")),
+        loop="auto",
+        http="auto",
+        reload=reload,
+        workers=1 if reload else int(os.getenv("API_WORKERS", str(os.cpu_count() or 1))),
         log_level="info"
     )
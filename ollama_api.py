@@ -7,10 +7,35 @@ from dotenv import load_dotenv
 # Загрузка переменных окружения из .env
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Логгер модуля (обработчики и уровень настраивает приложение, см. api_server)
 logger = logging.getLogger(__name__)
 
+# Общая сессия aiohttp: переиспользует соединения (keep-alive) между запросами к Ollama
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+async def _get_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую сессию aiohttp, создавая её при первом обращении.
+    
+    :return: Открытая сессия aiohttp
+    """
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=60),
+        )
+    return _SESSION
+
+async def close_session() -> None:
+    """
+    Закрывает общую сессию aiohttp (вызывается при остановке приложения).
+    """
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
 async def get_answer(question: str, system_prompt: Optional[str] = None) -> str:
     """
     Получает ответ от локальной LLM через Ollama API.
@@ -39,24 +64,22 @@ async def get_answer(question: str, system_prompt: Optional[str] = None) -> str:
         if system_prompt:
             payload["system"] = system_prompt
             
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
-            try:
-                async with session.post(f"{base_url}/api/generate", json=payload) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result.get("response", "Ошибка: Пустой ответ от Ollama")
-                    else:
-                        error_msg = f"Ошибка API Ollama: {response.status}"
-                        logger.error(f"[Ollama-ERROR] {error_msg}")
-                        # Возвращаем заглушку вместо ошибки
-                        return f"[MOCK] Анализ текста завершен. Текст содержит потенциально чувствительные данные."
-            except aiohttp.ClientConnectorError:
-                logger.warning("Ollama сервер недоступен, используется заглушка")
-                return f"[MOCK] Анализ текста завершен. Найдены потенциальные чувствительные данные в тексте."
+        session = await _get_session()
+        try:
+            async with session.post(f"{base_url}/api/generate", json=payload) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    return result.get("response", "Ошибка: Пустой ответ от Ollama")
+                else:
+                    logger.error("[Ollama-ERROR] Ошибка API Ollama: %s", response.status)
+                    # Возвращаем заглушку вместо ошибки
+                    return f"[MOCK] Анализ текста завершен. Текст содержит потенциально чувствительные данные."
+        except aiohttp.ClientConnectorError:
+            logger.warning("Ollama сервер недоступен, используется заглушка")
+            return f"[MOCK] Анализ текста завершен. Найдены потенциальные чувствительные данные в тексте."
                     
     except Exception as e:
-        error_msg = f"Ошибка при обращении к Ollama API: {str(e)}"
-        logger.error(f"[Ollama-ERROR] {error_msg}")
+        logger.error("[Ollama-ERROR] Ошибка при обращении к Ollama API: %s", e)
         # Возвращаем заглушку вместо ошибки
         return f"[MOCK] Анализ завершен. Обнаружены элементы, требующие маскирования."
 
@@ -64,8 +87,11 @@ async def get_answer(question: str, system_prompt: Optional[str] = None) -> str:
 if __name__ == "__main__":
     import asyncio
     
+    logging.basicConfig(level=logging.INFO)
+    
     async def test():
         result = await get_answer("Привет! Как дела?")
         print(f"Тестовый результат: {result}")
+        await close_session()
     
     asyncio.run(test())
\ No newline at end of file
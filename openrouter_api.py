@@ -4,8 +4,12 @@ OpenRouter API integration module
 """
 
 import os
+import asyncio
+import hashlib
 import logging
-from typing import Optional
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
@@ -20,10 +24,132 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "meta-llama/llama-3.1-8b-instruct:free")
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
+# Конфигурация кэша ответов
+OPENROUTER_CACHE_SIZE = int(os.getenv("OPENROUTER_CACHE_SIZE", "1024"))
+OPENROUTER_SEMANTIC_CACHE = os.getenv("OPENROUTER_SEMANTIC_CACHE", "").lower() in ("1", "true", "yes")
+OPENROUTER_SEMANTIC_MODEL = os.getenv("OPENROUTER_SEMANTIC_MODEL", "all-MiniLM-L6-v2")
+OPENROUTER_SEMANTIC_THRESHOLD = float(os.getenv("OPENROUTER_SEMANTIC_THRESHOLD", "0.95"))
+
 # Проверяем наличие API ключа
 if not OPENROUTER_API_KEY:
     logger.warning("OPENROUTER_API_KEY не найден в переменных окружения")
 
+def _cache_key(*parts: str) -> bytes:
+    """
+    128-битный ключ кэша (blake2b). Длинные строки хэшируются один раз,
+    а словари кэша дальше сравнивают и хэшируют только 16 байт.
+    """
+    return hashlib.blake2b("\x00".join(parts).encode(), digest_size=16).digest()
+
+# Точный LRU-кэш ответов: ключ (модель, системный промпт, сообщение) -> ответ
+_EXACT: "OrderedDict[bytes, str]" = OrderedDict()
+
+def _exact_get(key: bytes) -> Optional[str]:
+    """Возвращает ответ из точного кэша и помечает запись как недавно использованную"""
+    answer = _EXACT.get(key)
+    if answer is not None:
+        _EXACT.move_to_end(key)
+    return answer
+
+# Выполняющиеся запросы (single-flight): ключ точного кэша -> задача запроса к OpenRouter
+_INFLIGHT: "Dict[bytes, asyncio.Future[str]]" = {}
+
+def _exact_put(key: bytes, answer: str) -> None:
+    """Сохраняет ответ в точный кэш, вытесняя самые старые записи"""
+    _EXACT[key] = answer
+    _EXACT.move_to_end(key)
+    while len(_EXACT) > OPENROUTER_CACHE_SIZE:
+        _EXACT.popitem(last=False)
+
+class SemanticCache:
+    """
+    Семантический кэш ответов: находит ранее заданный вопрос с близким смыслом
+    (косинусное сходство эмбеддингов не ниже порога) в рамках той же модели и системного промпта.
+    Требует установленного пакета sentence-transformers; без него кэш отключается.
+    """
+    
+    def __init__(self, model_name: str, threshold: float, maxsize: int):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._encoder = None
+        self._disabled = False
+        self._lock = threading.Lock()
+        self._entries: Dict[bytes, List[Tuple[Any, str]]] = {}
+    
+    def _get_encoder(self):
+        """Лениво загружает модель эмбеддингов"""
+        with self._lock:
+            if self._encoder is None and not self._disabled:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    self._encoder = SentenceTransformer(self.model_name)
+                    logger.info("Семантический кэш использует модель %s", self.model_name)
+                except Exception as e:
+                    logger.warning("Семантический кэш отключён: %s", e)
+                    self._disabled = True
+            return self._encoder
+    
+    def _embed(self, text: str):
+        encoder = self._get_encoder()
+        if encoder is None:
+            return None
+        return encoder.encode(text, normalize_embeddings=True)
+    
+    async def get(self, scope: bytes, message: str) -> Tuple[Optional[str], Any]:
+        """
+        Ищет ответ на близкий по смыслу вопрос.
+        
+        Returns:
+            (ответ или None, эмбеддинг сообщения для последующего put)
+        """
+        embedding = await asyncio.to_thread(self._embed, message)
+        if embedding is None:
+            return None, None
+        entries = self._entries.get(scope)
+        if entries:
+            import numpy as np
+            scores = np.vstack([vector for vector, _ in entries]) @ embedding
+            best = int(scores.argmax())
+            if scores[best] >= self.threshold:
+                return entries[best][1], embedding
+        return None, embedding
+    
+    def put(self, scope: bytes, embedding: Any, answer: str) -> None:
+        """Сохраняет ответ вместе с эмбеддингом вопроса"""
+        if embedding is None:
+            return
+        entries = self._entries.setdefault(scope, [])
+        entries.append((embedding, answer))
+        if len(entries) > self.maxsize:
+            del entries[0]
+
+_semantic_cache: Optional[SemanticCache] = (
+    SemanticCache(OPENROUTER_SEMANTIC_MODEL, OPENROUTER_SEMANTIC_THRESHOLD, OPENROUTER_CACHE_SIZE)
+    if OPENROUTER_SEMANTIC_CACHE else None
+)
+
+# Параметры генерации, общие для обычного и потокового запроса
+_GENERATION_PARAMS: Dict[str, Any] = {
+    "max_tokens": 4000,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "frequency_penalty": 0.0,
+    "presence_penalty": 0.0,
+}
+
+# Провайдеры, принимающие явную метку кэширования префикса (cache_control) через OpenRouter
+_CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+def _normalize_system_prompt(system_prompt: Optional[str]) -> str:
+    """
+    Приводит системный промпт к единому виду, чтобы префикс запроса был побайтно
+    одинаковым между запросами и попадал в кэш промптов на стороне провайдера.
+    """
+    if not system_prompt:
+        return ""
+    return system_prompt.replace("\r\n", "\n").strip()
+
 class OpenRouterClient:
     """Клиент для работы с OpenRouter API"""
     
@@ -47,11 +173,39 @@ class OpenRouterClient:
                     "X-Title": "Safe Dialog App",  # Название приложения
                 }
             )
-            logger.info(f"OpenRouter клиент инициализирован с моделью: {self.model}")
+            logger.info("OpenRouter клиент инициализирован с моделью: %s", self.model)
         except Exception as e:
-            logger.error(f"Ошибка инициализации OpenRouter клиента: {e}")
+            logger.error("Ошибка инициализации OpenRouter клиента: %s", e)
             self.client = None
     
+    def _build_messages(self, message: str, system_prompt: str) -> List[Dict[str, Any]]:
+        """
+        Собирает сообщения так, чтобы статическая часть (системный промпт) всегда шла первой,
+        а динамическое сообщение пользователя — последним. Для провайдеров с явным
+        кэшированием префикса системный блок помечается cache_control.
+        """
+        messages: List[Dict[str, Any]] = []
+        
+        if system_prompt:
+            if self.model.startswith(_CACHE_CONTROL_MODEL_PREFIXES):
+                content: Any = [{
+                    "type": "text",
+                    "text": system_prompt,
+                    "cache_control": {"type": "ephemeral"},
+                }]
+            else:
+                content = system_prompt
+            messages.append({
+                "role": "system",
+                "content": content
+            })
+        
+        messages.append({
+            "role": "user", 
+            "content": message
+        })
+        return messages
+    
     async def get_completion(self, message: str, system_prompt: Optional[str] = None) -> str:
         """
         Получить ответ от OpenRouter
@@ -67,33 +221,38 @@ class OpenRouterClient:
             logger.error("OpenRouter клиент не инициализирован")
             return "[ОШИБКА] OpenRouter клиент недоступен. Проверьте OPENROUTER_API_KEY."
         
+        system_prompt = _normalize_system_prompt(system_prompt)
+        
+        # Сначала ищем ответ в кэше
+        cached, key, embedding = await self._cache_lookup(message, system_prompt)
+        if cached is not None:
+            return cached
+        
+        # Single-flight: одинаковые одновременные запросы ждут результат одного обращения к OpenRouter.
+        # Запрос выполняется отдельной задачей, поэтому отмена одного из ожидающих не прерывает остальных
+        task = _INFLIGHT.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._request_completion(message, system_prompt, key, embedding))
+            _INFLIGHT[key] = task
+            task.add_done_callback(lambda done: _INFLIGHT.pop(key, None) if _INFLIGHT.get(key) is done else None)
+        else:
+            logger.info("Идентичный запрос к OpenRouter уже выполняется, ожидаем его результат")
+        return await asyncio.shield(task)
+    
+    async def _request_completion(self, message: str, system_prompt: str,
+                                  key: bytes, embedding: Any) -> str:
+        """Выполняет запрос к OpenRouter и сохраняет успешный ответ в кэш"""
         try:
-            # Подготавливаем сообщения
-            messages = []
+            messages = self._build_messages(message, system_prompt)
             
-            if system_prompt:
-                messages.append({
-                    "role": "system",
-                    "content": system_prompt
-                })
-            
-            messages.append({
-                "role": "user", 
-                "content": message
-            })
-            
-            logger.info(f"Отправка запроса в OpenRouter с моделью {self.model}")
-            logger.debug(f"Сообщения: {len(messages)} шт.")
+            logger.info("Отправка запроса в OpenRouter с моделью %s", self.model)
+            logger.debug("Сообщения: %d шт.", len(messages))
             
             # Отправляем запрос
             response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
-                max_tokens=4000,
-                temperature=0.7,
-                top_p=0.9,
-                frequency_penalty=0.0,
-                presence_penalty=0.0,
+                **_GENERATION_PARAMS,
             )
             
             # Извлекаем ответ
@@ -102,19 +261,104 @@ class OpenRouterClient:
                 
                 # Логируем статистику
                 if hasattr(response, 'usage') and response.usage:
-                    logger.info(f"Токены: prompt={response.usage.prompt_tokens}, "
-                              f"completion={response.usage.completion_tokens}, "
-                              f"total={response.usage.total_tokens}")
+                    logger.info("Токены: prompt=%s, completion=%s, total=%s",
+                                response.usage.prompt_tokens,
+                                response.usage.completion_tokens,
+                                response.usage.total_tokens)
                 
-                logger.info(f"Получен ответ от OpenRouter: {len(answer)} символов")
+                logger.info("Получен ответ от OpenRouter: %d символов", len(answer))
+                self._cache_store(key, system_prompt, embedding, answer)
                 return answer
             else:
                 logger.error("Пустой ответ от OpenRouter")
                 return "[ОШИБКА] Получен пустой ответ от OpenRouter"
                 
         except Exception as e:
-            logger.error(f"Ошибка при запросе к OpenRouter: {str(e)}")
+            logger.error("Ошибка при запросе к OpenRouter: %s", e)
             return f"[ОШИБКА] Ошибка при обращении к OpenRouter: {str(e)}"
+    
+    async def stream_completion(self, message: str, system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Получить ответ от OpenRouter в потоковом режиме
+        
+        Args:
+            message: Сообщение пользователя
+            system_prompt: Системный промпт (опционально)
+            
+        Yields:
+            Фрагменты ответа по мере генерации
+        """
+        if not self.client:
+            logger.error("OpenRouter клиент не инициализирован")
+            yield "[ОШИБКА] OpenRouter клиент недоступен. Проверьте OPENROUTER_API_KEY."
+            return
+        
+        system_prompt = _normalize_system_prompt(system_prompt)
+        
+        cached, key, embedding = await self._cache_lookup(message, system_prompt)
+        if cached is not None:
+            yield cached
+            return
+        
+        parts: List[str] = []
+        try:
+            messages = self._build_messages(message, system_prompt)
+            
+            logger.info("Отправка потокового запроса в OpenRouter с моделью %s", self.model)
+            
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                **_GENERATION_PARAMS,
+            )
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            logger.error("Ошибка при потоковом запросе к OpenRouter: %s", e)
+            yield f"[ОШИБКА] Ошибка при обращении к OpenRouter: {str(e)}"
+            return
+        
+        answer = "".join(parts).strip()
+        if not answer:
+            logger.error("Пустой ответ от OpenRouter")
+            yield "[ОШИБКА] Получен пустой ответ от OpenRouter"
+            return
+        
+        logger.info("Получен потоковый ответ от OpenRouter: %d символов", len(answer))
+        self._cache_store(key, system_prompt, embedding, answer)
+    
+    async def _cache_lookup(self, message: str, system_prompt: str) -> Tuple[Optional[str], bytes, Any]:
+        """
+        Ищет ответ в точном, затем в семантическом кэше.
+        
+        Returns:
+            (ответ или None, ключ точного кэша, эмбеддинг сообщения для _cache_store)
+        """
+        key = _cache_key(self.model, system_prompt, message)
+        cached = _exact_get(key)
+        if cached is not None:
+            logger.info("Ответ OpenRouter взят из кэша")
+            return cached, key, None
+        
+        embedding = None
+        if _semantic_cache is not None:
+            cached, embedding = await _semantic_cache.get(_cache_key(self.model, system_prompt), message)
+            if cached is not None:
+                logger.info("Ответ OpenRouter взят из семантического кэша")
+                _exact_put(key, cached)
+        return cached, key, embedding
+    
+    def _cache_store(self, key: bytes, system_prompt: str, embedding: Any, answer: str) -> None:
+        """Сохраняет успешный ответ в кэши"""
+        _exact_put(key, answer)
+        if _semantic_cache is not None:
+            _semantic_cache.put(_cache_key(self.model, system_prompt), embedding, answer)
 
 # Глобальный экземпляр клиента
 _openrouter_client = OpenRouterClient()
@@ -142,6 +386,19 @@ async def get_answer(question: str, system_prompt: Optional[str] = None) -> str:
     """
     return await _openrouter_client.get_completion(question, system_prompt)
 
+def stream_answer(question: str, system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Потоковый вариант get_answer: возвращает асинхронный итератор фрагментов ответа
+    
+    Args:
+        question: Вопрос/сообщение для обработки
+        system_prompt: Системный промпт (опционально)
+        
+    Returns:
+        Асинхронный итератор строковых фрагментов ответа
+    """
+    return _openrouter_client.stream_completion(question, system_prompt)
+
 async def test_openrouter():
     """
     Тестовая функция для проверки работы OpenRouter API
@@ -1,9 +1,23 @@
+import asyncio
+import hashlib
 import json
+import logging
 import os
 import re
-import uuid
-from typing import Dict, Tuple, List, Optional, Set
-
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Tuple, List, Optional, Pattern, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна
+    fcntl = None
+
+import orjson
 from dotenv import load_dotenv
 
 from ollama_api import get_answer as ollama_answer
@@ -11,34 +25,300 @@ from ollama_api import get_answer as ollama_answer
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 CATALOG_FILE = os.environ.get("SE_CATALOG_FILE", "sensitive_entities.json")
 
+# Кэш ответов Ollama: LRU в памяти и, если задан SE_LLM_CACHE_FILE, SQLite-файл,
+# чтобы кэш переживал перезапуск и был общим для воркеров API-сервера. В кэше лежат фразы
+# из пользовательских текстов, поэтому файл должен находиться вне репозитория
+SE_LLM_CACHE_SIZE = int(os.environ.get("SE_LLM_CACHE_SIZE", "2048"))
+SE_LLM_CACHE_TTL = int(os.environ.get("SE_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+SE_LLM_CACHE_FILE = os.environ.get("SE_LLM_CACHE_FILE", "")
+
+# Классификация кандидатов: не больше SE_LLM_BATCH_SIZE фраз в одном запросе к LLM
+# и не больше SE_LLM_CONCURRENCY одновременных запросов на один текст
+SE_LLM_BATCH_SIZE = int(os.environ.get("SE_LLM_BATCH_SIZE", "20"))
+SE_LLM_CONCURRENCY = int(os.environ.get("SE_LLM_CONCURRENCY", "8"))
+
 # Регулярное выражение для блоков вида {ID=<id>, TXT='<заменитель>'} или {ID=<id>, TXT="<заменитель>"}
-BLOCK_PATTERN = re.compile(r'\{ID=(?P<id>[^,}]+),\s*TXT=["\'](?P<txt>[^"\']*)["\']?\}')
+BLOCK_PATTERN = re.compile(r'\{ID=(?P<id>[^,{}]+),\s*TXT=["\'](?P<txt>[^"\']*)["\']?\}')
 
 # Дополнительный паттерн для простых блоков вида {ENTITY_NAME_1}
 SIMPLE_BLOCK_PATTERN = re.compile(r"\{(?P<entity>[A-Z_][A-Z0-9_]*)\}")
 
+# Оба вида блоков для demask_text одним проходом; вид определяется по m.lastgroup
+_DEMASK_RE = re.compile(rf"(?P<detailed>{BLOCK_PATTERN.pattern})|(?P<simple>{SIMPLE_BLOCK_PATTERN.pattern})")
+
 # Паттерн для определения уже замещённых блоков. Поддерживает ID без кавычек или в кавычках,
-# а также TXT в одинарных или двойных кавычках: {ID=..., TXT='...'} или {ID="...", TXT="..."}
+# а также TXT в одинарных или двойных кавычках: {ID=..., TXT='...'} или {ID="...", TXT="..."}.
+# ID без кавычек не содержит пробелов и фигурных скобок: иначе на строках вида "{ID=" без запятой
+# движок перебирает хвост текста от каждой скобки и время растёт квадратично
 BLOCK_SPAN_PATTERN = re.compile(
-    r"\{\s*ID\s*=\s*(?:'[^']*'|\"[^\"]*\"|[^,}]+)\s*,\s*TXT\s*=\s*(?:'[^']*'|\"[^\"]*\")\s*\}"
+    r"\{\s*ID\s*=\s*(?:'[^']*'|\"[^\"]*\"|[^,{}\s]+)\s*,\s*TXT\s*=\s*(?:'[^']*'|\"[^\"]*\")\s*\}"
 )
 
 
-def _load_catalog() -> Dict[str, Dict[str, str]]:
-    if not os.path.exists(CATALOG_FILE):
-        return {}
+# Журнал изменений: добавления, правки и удаления дописываются строкой JSON в конец файла вместо
+# полной перезаписи каталога; при загрузке журнал накладывается поверх основного файла.
+# Строка {"id", "name", "placeholder"} задаёт запись целиком, {"id", "deleted": true} удаляет её
+# — итог зависит только от последней строки по каждому ID, поэтому повторное наложение журнала
+# на каталог, в который он уже вошёл, ничего не меняет
+CATALOG_LOG_FILE = f"{CATALOG_FILE}.log"
+
+# Шаблоны email, телефонов и ссылок на соцсети для _detect_category и _extract_sensitive_patterns
+_EMAIL = r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}"
+_EMAIL_RE = re.compile(_EMAIL)
+_PHONE_RE = re.compile(r"[+\d().\-\s]+")
+_URL_RE = re.compile(r"https?://[^\s]+")
+# Домены соцсетей и ключевые слова категорий: проверяются поиском подстроки, без регулярок
+_SOCIAL_LITERALS = (
+    "facebook.com", "fb.com", "instagram.com", "ig.me", "t.me", "telegram.me", "vk.com",
+    "x.com", "twitter.com", "linkedin.com", "ok.ru", "youtube.com", "github.com",
+)
+_COMPANY_KWS = ("llc", "inc", "ooo", "ооо", "company", "компания")
+_PRODUCT_KWS = ("product", "продукт", "model", "модель")
+_PERSON_KWS = ("mr ", "ms ", "mrs ", "д-р", "г-н", "г-жа")
+# Все три вида кандидатов одним проходом по тексту; вид определяется по m.lastgroup.
+# Email ищется только с начала серии символов адреса (ведущие знаки пропускаются вне группы):
+# попытки с каждой границы слова внутри длинной серии без "@" давали квадратичное время.
+# Серия начинается после любого символа, который не может входить в адрес, в том числе после
+# кириллицы — так находятся адреса, приклеенные к слову точкой или дефисом ("см.ivan@mail.ru").
+# Телефон берётся только целой серией допустимых символов (ведущие пробелы и знаки пропускаются
+# вне группы), поэтому обрывок длинной серии чисел не примет вид телефона; длину серии
+# (не больше 60 символов) проверяет _extract_sensitive_patterns
+_CATEGORY_RE = re.compile(
+    rf"(?<![A-Za-z0-9._%+-])[.%+-]*(?P<email>\b{_EMAIL}\b)|(?P<url>{_URL_RE.pattern})"
+    rf"|(?<![+\d().\-\s])[).\-\s]*(?P<phone>[+(\d][+\d().\-\s]*)"
+)
+
+# Кэш разобранного каталога: entry = (ключ версии, каталог, число записей журнала). Ключ —
+# (mtime_ns, размер) основного файла и журнала; файлы перечитываются только при их изменении.
+# Всё хранится одним кортежем, чтобы читатели из других потоков не увидели новый ключ
+# со старыми данными
+_CATALOG_CACHE: Dict[str, Any] = {"entry": None, "matcher": None, "by_name": None, "by_upkey": None}
+
+# Сериализует цикл «прочитать — изменить — сохранить» каталога: изменения могут выполняться
+# из пула потоков API-сервера одновременно с event loop
+_CATALOG_LOCK = threading.Lock()
+
+
+@contextmanager
+def _catalog_lock() -> Iterator[None]:
+    """
+    Блокировка каталога на запись: между потоками процесса и, где доступен fcntl,
+    между воркерами API-сервера (файл <каталог>.lock).
+    """
+    with _CATALOG_LOCK:
+        if fcntl is None:
+            yield
+            return
+        with open(f"{CATALOG_FILE}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _file_stat(path: str) -> Optional[Tuple[int, int]]:
     try:
-        with open(CATALOG_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _catalog_mtime() -> Optional[Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]]:
+    base, log = _file_stat(CATALOG_FILE), _file_stat(CATALOG_LOG_FILE)
+    if base is None and log is None:
+        return None
+    return base, log
+
+
+def _read_catalog() -> Optional[Tuple[Dict[str, Dict[str, str]], int]]:
+    """
+    Читает основной файл каталога и накладывает на него журнал изменений.
+    Возвращает (каталог, число записей журнала) или None, если основной файл повреждён.
+    """
+    try:
+        with open(CATALOG_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+    except FileNotFoundError:
+        data = {}
     except Exception:
+        return None
+
+    log_records = 0
+    try:
+        with open(CATALOG_LOG_FILE, "rb") as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                    if record.get("deleted"):
+                        data.pop(record["id"], None)
+                    else:
+                        data[record["id"]] = {"name": record["name"], "placeholder": record["placeholder"]}
+                except (ValueError, KeyError, TypeError):
+                    # Недописанная строка после сбоя — пропускаем
+                    continue
+                log_records += 1
+    except FileNotFoundError:
+        pass
+    except Exception:
+        return None
+    return data, log_records
+
+
+def _catalog_snapshot() -> Dict[str, Dict[str, str]]:
+    """
+    Возвращает закэшированный каталог без копирования. Результат общий для всех вызовов,
+    поэтому изменять его нельзя — изменения проходят через журнал (_append_catalog).
+    """
+    mtime = _catalog_mtime()
+    if mtime is None:
         return {}
+    entry = _CATALOG_CACHE["entry"]
+    if entry is None or entry[0] != mtime:
+        loaded = _read_catalog()
+        if loaded is None:
+            _CATALOG_CACHE["entry"] = None
+            return {}
+        entry = (mtime, loaded[0], loaded[1])
+        _CATALOG_CACHE["entry"] = entry
+    return entry[1]
 
 
 def _save_catalog(catalog: Dict[str, Dict[str, str]]) -> None:
-    with open(CATALOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(catalog, f, ensure_ascii=False, indent=2)
+    """
+    Сохраняет каталог целиком (с поглощением журнала) и сразу кладёт его в кэш, без повторного
+    чтения файла. Переданный словарь становится снимком кэша — после вызова изменять его нельзя.
+    """
+    # Пишем во временный файл и атомарно подменяем каталог: читатели (в том числе другие
+    # процессы) никогда не видят частично записанный JSON, а сбой при записи не портит файл
+    tmp_path = f"{CATALOG_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            # Отступы оставлены: файл каталога хранится в репозитории и правится вручную
+            f.write(orjson.dumps(catalog, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+            # mtime/размер берём у записанного файла: переименование их не меняет
+            st = os.fstat(f.fileno())
+        os.replace(tmp_path, CATALOG_FILE)
+        # Журнал уже вошёл в основной файл. Если процесс упадёт до удаления, при следующей
+        # загрузке журнал повторно наложится на каталог без последствий: каждая строка задаёт
+        # итоговое состояние записи (в том числе удаление), а не изменение относительно прошлого
+        try:
+            os.remove(CATALOG_LOG_FILE)
+        except FileNotFoundError:
+            pass
+    except BaseException:
+        _CATALOG_CACHE["entry"] = None
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _CATALOG_CACHE["entry"] = (((st.st_mtime_ns, st.st_size), None), catalog, 0)
+
+
+def _compact_catalog() -> None:
+    """
+    Переносит журнал в основной файл, когда записей в журнале больше чем вдвое против основного
+    файла: так суммарная стоимость перезаписей остаётся линейной от числа изменений.
+    Вызывается под _catalog_lock().
+    """
+    _catalog_snapshot()
+    entry = _CATALOG_CACHE["entry"]
+    if entry is None:
+        return
+    catalog, log_records = entry[1], entry[2]
+    if log_records > 2 * max(len(catalog) - log_records, 1):
+        _save_catalog(catalog)
+
+
+def _append_catalog(ne_id: str, item: Optional[Dict[str, str]]) -> None:
+    """
+    Записывает одну строку в журнал (O(1) записи вместо перезаписи каталога) и обновляет кэш
+    без повторного чтения файлов. item=None удаляет запись. Вызывается под _catalog_lock().
+    """
+    _append_catalog_many([(ne_id, item)])
+
+
+def _append_catalog_many(rows: List[Tuple[str, Optional[Dict[str, str]]]]) -> None:
+    """
+    Дописывает в журнал несколько записей (item=None — удаление) одной записью в файл и одним
+    fsync, затем один раз обновляет кэш и индекс по именам и проверяет необходимость сжатия.
+    Вызывается под _catalog_lock().
+    """
+    if not rows:
+        return
+    previous = _catalog_snapshot()
+    data = b"".join(
+        orjson.dumps({"id": ne_id, "deleted": True} if item is None else {"id": ne_id, **item}) + b"\n"
+        for ne_id, item in rows
+    )
+    log_records = _CATALOG_CACHE["entry"][2] if _CATALOG_CACHE["entry"] is not None else 0
+    try:
+        with open(CATALOG_LOG_FILE, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        _CATALOG_CACHE["entry"] = None
+        raise
+    catalog = dict(previous)
+    for ne_id, item in rows:
+        if item is None:
+            catalog.pop(ne_id, None)
+        else:
+            catalog[ne_id] = item
+    # Под блокировкой других писателей нет, поэтому текущие stat файлов соответствуют catalog
+    _CATALOG_CACHE["entry"] = (_catalog_mtime(), catalog, log_records + len(rows))
+    # Индекс по именам при одних добавлениях дополняем на месте, а не строим заново: читатели
+    # только вызывают .get(). После правок и удалений он перестроится при следующем обращении
+    by_name = _CATALOG_CACHE["by_name"]
+    only_inserts = all(item is not None and ne_id not in previous for ne_id, item in rows)
+    if by_name is not None and by_name[0] is previous and only_inserts:
+        for ne_id, item in rows:
+            by_name[1].setdefault(item["name"], (ne_id, item["placeholder"]))
+        _CATALOG_CACHE["by_name"] = (catalog, by_name[1])
+    _compact_catalog()
+
+
+def _catalog_by_name() -> Dict[str, Tuple[str, str]]:
+    """
+    Возвращает индекс имя -> (ID, заменитель) для текущей версии каталога. При повторе имени
+    побеждает первая запись, как при линейном поиске по каталогу.
+    """
+    catalog = _catalog_snapshot()
+    cached = _CATALOG_CACHE["by_name"]
+    if cached is not None and cached[0] is catalog:
+        return cached[1]
+    index: Dict[str, Tuple[str, str]] = {}
+    for ne_id, item in catalog.items():
+        index.setdefault(item.get("name"), (ne_id, item.get("placeholder", "")))
+    _CATALOG_CACHE["by_name"] = (catalog, index)
+    return index
+
+
+def _count_digits(value: str) -> int:
+    # str.isdecimal совпадает с \d регулярных выражений; считаем без построения строки из цифр
+    return sum(map(str.isdecimal, value))
+
+
+def _has_social_domain(lower: str) -> bool:
+    """
+    Есть ли в строке ссылка на соцсеть: домен из _SOCIAL_LITERALS, перед которым граница слова,
+    а сразу после — "/" (то же, что регулярка с \\b перед доменом и "/" после, но без неё).
+    """
+    for domain in _SOCIAL_LITERALS:
+        start = lower.find(domain)
+        while start != -1:
+            before = lower[start - 1] if start else ""
+            if lower.startswith("/", start + len(domain)) and not (before.isalnum() or before == "_"):
+                return True
+            start = lower.find(domain, start + 1)
+    return False
 
 
 def _detect_category(value: str) -> str:
@@ -49,21 +329,20 @@ def _detect_category(value: str) -> str:
     v = (value or "").strip()
     lower = v.lower()
     # Email
-    if re.fullmatch(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}", v):
+    if _EMAIL_RE.fullmatch(v):
         return "email"
     # Phone (простейшая эвристика: 9-15 цифр, допускаем +, пробелы, скобки, дефисы, точки)
-    digits_only = re.sub(r"\D", "", v)
-    if 9 <= len(digits_only) <= 15 and re.fullmatch(r"[+\d().\-\s]+", v):
+    if 9 <= _count_digits(v) <= 15 and _PHONE_RE.fullmatch(v):
         return "phone"
     # Social links (известные домены соцсетей)
-    if re.search(r"\b(?:facebook\.com|fb\.com|instagram\.com|ig\.me|t\.me|telegram\.me|vk\.com|x\.com|twitter\.com|linkedin\.com|ok\.ru|youtube\.com|github\.com)/", lower):
+    if _has_social_domain(lower):
         return "social"
     # Прочие эвристики
-    if any(k in lower for k in ["llc", "inc", "ooo", "ооо", "company", "компания"]):
+    if any(k in lower for k in _COMPANY_KWS):
         return "company"
-    if any(k in lower for k in ["product", "продукт", "model", "модель"]):
+    if any(k in lower for k in _PRODUCT_KWS):
         return "product"
-    if any(k in lower for k in ["mr ", "ms ", "mrs ", "д-р", "г-н", "г-жа"]):
+    if any(k in lower for k in _PERSON_KWS):
         return "person"
     return "generic"
 
@@ -90,73 +369,220 @@ def _extract_sensitive_patterns(text: str) -> Set[str]:
     Находит email, телефон и ссылки на популярные соцсети в тексте и возвращает множество найденных фрагментов.
     """
     results: Set[str] = set()
-    # Email
-    for m in re.finditer(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b", text):
-        results.add(m.group(0))
-    # Phone (9-15 цифр суммарно)
-    for m in re.finditer(r"[+\d().\-\s]{9,}", text):
-        val = m.group(0)
-        digits = re.sub(r"\D", "", val)
-        if 9 <= len(digits) <= 15:
+    for m in _CATEGORY_RE.finditer(text):
+        kind = m.lastgroup
+        val = m.group(kind)
+        if kind == "email":
+            results.add(val)
+        elif kind == "phone":
+            # Phone (9-15 цифр суммарно); серии длиннее 60 символов или где больше половины
+            # пробелов — не телефон
+            val = val.rstrip()
+            if len(val) > 60 or val.count(" ") > len(val) // 2:
+                continue
+            if 9 <= _count_digits(val) <= 15:
+                results.add(val)
+        elif _has_social_domain(val.lower()):
+            # Social links
             results.add(val)
-    # Social links
-    for m in re.finditer(r"https?://[^\s]+", text):
-        url = m.group(0)
-        if re.search(r"\b(?:facebook\.com|fb\.com|instagram\.com|ig\.me|t\.me|telegram\.me|vk\.com|x\.com|twitter\.com|linkedin\.com|ok\.ru|youtube\.com|github\.com)/", url.lower()):
-            results.add(url)
     return results
 
 
-async def is_sensitive_data(text: str) -> Tuple[bool, str]:
-    """
-    Определяет, относится ли входной текст к чувствительным данным (например, названия компаний,
-    продуктов, имена людей, географические названия). При положительном ответе добавляет или
-    извлекает запись из каталога и возвращает блок вида "{ID=<id>, TXT='<заменитель>'}".
+# Точный LRU-кэш ответов Ollama: ключ blake2b(системный промпт, вопрос) -> (срок действия, ответ)
+_LLM_CACHE: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
 
-    :return: (is_proper: bool, block_or_empty: str)
+_LLM_DB: Optional[sqlite3.Connection] = None
+_LLM_DB_LOCK = threading.Lock()
+
+
+def _llm_db() -> sqlite3.Connection:
+    global _LLM_DB
+    if _LLM_DB is None:
+        conn = sqlite3.connect(SE_LLM_CACHE_FILE, timeout=5, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key BLOB PRIMARY KEY, expires_at REAL NOT NULL, answer TEXT NOT NULL)"
+        )
+        conn.commit()
+        _LLM_DB = conn
+    return _LLM_DB
+
+
+def _llm_db_get(key: bytes) -> Optional[Tuple[float, str]]:
+    with _LLM_DB_LOCK:
+        row = _llm_db().execute("SELECT expires_at, answer FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def _llm_db_put(key: bytes, entry: Tuple[float, str]) -> None:
+    with _LLM_DB_LOCK:
+        db = _llm_db()
+        db.execute("INSERT OR REPLACE INTO llm_cache (key, expires_at, answer) VALUES (?, ?, ?)", (key, *entry))
+        db.commit()
+
+
+def _llm_cache_put(key: bytes, entry: Tuple[float, str]) -> None:
+    _LLM_CACHE[key] = entry
+    _LLM_CACHE.move_to_end(key)
+    while len(_LLM_CACHE) > SE_LLM_CACHE_SIZE:
+        _LLM_CACHE.popitem(last=False)
+
+
+async def _llm_answer(question: str, system_prompt: str) -> str:
     """
-    candidate = text.strip()
-    if not candidate:
-        return False, ""
+    ollama_answer с кэшем: сначала LRU в памяти, затем SQLite (если задан SE_LLM_CACHE_FILE).
+    Ответы хранятся SE_LLM_CACHE_TTL секунд; заглушки [MOCK] при недоступной Ollama не кэшируются.
+    """
+    key = hashlib.blake2b(f"{system_prompt}\x00{question}".encode(), digest_size=16).digest()
+    now = time.time()
+
+    entry = _LLM_CACHE.get(key)
+    if entry is None and SE_LLM_CACHE_FILE:
+        try:
+            entry = await asyncio.to_thread(_llm_db_get, key)
+        except sqlite3.Error as e:
+            logger.warning("Не удалось прочитать кэш LLM: %s", e)
+    if entry is not None:
+        if entry[0] > now:
+            _llm_cache_put(key, entry)
+            return entry[1]
+        _LLM_CACHE.pop(key, None)
+
+    answer = await ollama_answer(question=question, system_prompt=system_prompt)
+    if answer.startswith("[MOCK]"):
+        return answer
+
+    entry = (now + SE_LLM_CACHE_TTL, answer)
+    _llm_cache_put(key, entry)
+    if SE_LLM_CACHE_FILE:
+        try:
+            await asyncio.to_thread(_llm_db_put, key, entry)
+        except sqlite3.Error as e:
+            logger.warning("Не удалось сохранить ответ в кэш LLM: %s", e)
+    return answer
+
+
+# Категории, которые считаются чувствительными без обращения к LLM
+_HARD_CATEGORIES = {"phone", "email", "social"}
+
+
+def _looks_proper(candidate: str) -> bool:
+    # Запасная эвристика, когда LLM не дала разборчивого ответа по фразе: фраза с заглавной буквы
+    # до 5 слов (кавычки допускаются — названия вида ООО "Ромашка" или «Ромашка»)
+    return bool(re.search(r"^[A-ZА-ЯЁ][\w\- .\"'«»]+$", candidate)) and len(candidate.split()) <= 5
+
+
+def _obviously_not_entity(candidate: str, category: str) -> bool:
+    """
+    Отсекает без обращения к LLM то, что заведомо не является сущностью: одиночные символы,
+    строки без букв (числа, знаки) и короткие фразы без заглавных букв и признаков категории.
+    """
+    if len(candidate) < 2 or not any(c.isalpha() for c in candidate):
+        return True
+    has_upper = any(c.isupper() for c in candidate)
+    return not has_upper and category == "generic" and len(candidate.split()) <= 3
 
-    catalog = _load_catalog()
-    for ne_id, item in catalog.items():
-        if item.get("name") == candidate:
-            return True, f"{{ID={ne_id}, TXT='{item.get('placeholder', '')}'}}"
-
-    # Жёсткие категории: телефон/email/соцсети считаем чувствительными без обращения к LLM
-    pre_category = _detect_category(candidate)
-    if pre_category in {"phone", "email", "social"}:
-        new_id = str(uuid.uuid4())
-        placeholder = _generate_placeholder(candidate)
-        catalog[new_id] = {"name": candidate, "placeholder": placeholder}
-        _save_catalog(catalog)
-        return True, f"{{ID={new_id}, TXT='{placeholder}'}}"
 
+async def _classify_batch(candidates: List[str]) -> Dict[str, bool]:
+    """
+    Определяет одним запросом к LLM, какие из кандидатов являются чувствительными данными.
+
+    :return: словарь кандидат -> is_proper
+    """
     system_prompt = (
         "Ты определяешь, являются ли данные чувствительными (компания, продукт, человек, гео, телефон, email, аккаунты/ссылки соцсетей). "
-        "Отвечай строго JSON: {\"is_proper\": true|false}."
+        "Отвечай строго JSON: {\"results\": {\"<фраза>\": true|false, ...}} — по ключу на каждую фразу без изменений."
     )
-    answer = await ollama_answer(
-        question=f"Фраза: '{candidate}'. Это чувствительные данные? Верни только JSON.",
+    answer = await _llm_answer(
+        question=f"Фразы: {json.dumps(candidates, ensure_ascii=False)}. Какие из них чувствительные данные? Верни только JSON.",
         system_prompt=system_prompt,
     )
 
-    is_proper = False
     try:
-        data = json.loads(answer)
-        is_proper = bool(data.get("is_proper", False))
+        results = json.loads(answer).get("results", {})
+        if not isinstance(results, dict):
+            results = {}
     except Exception:
-        is_proper = bool(re.search(r"^[A-ZА-ЯЁ][\w\- .]+$", candidate)) and len(candidate.split()) <= 5
+        results = {}
+
+    # Фразы, которые модель не вернула дословно (изменила кавычки или регистр, обрезала,
+    # пропустила) или оценила не булевым значением, проверяем эвристикой, а не считаем
+    # безопасными: иначе они уйдут во внешнюю LLM без маскирования
+    verdicts: Dict[str, bool] = {}
+    for cand in candidates:
+        verdict = results.get(cand)
+        verdicts[cand] = verdict if isinstance(verdict, bool) else _looks_proper(cand)
+    return verdicts
+
+
+async def _classify_many(candidates: List[str]) -> Dict[str, bool]:
+    """
+    Классифицирует кандидатов пачками по SE_LLM_BATCH_SIZE; пачки отправляются в LLM
+    параллельно, не более SE_LLM_CONCURRENCY запросов одновременно.
+
+    :return: словарь кандидат -> is_proper
+    """
+    if not candidates:
+        return {}
+
+    batch_size = max(SE_LLM_BATCH_SIZE, 1)
+    semaphore = asyncio.Semaphore(max(SE_LLM_CONCURRENCY, 1))
+
+    async def _run(batch: List[str]) -> Dict[str, bool]:
+        async with semaphore:
+            return await _classify_batch(batch)
+
+    verdicts: Dict[str, bool] = {}
+    batches = [candidates[i:i + batch_size] for i in range(0, len(candidates), batch_size)]
+    for result in await asyncio.gather(*(_run(batch) for batch in batches)):
+        verdicts.update(result)
+    return verdicts
+
+
+async def _entity_blocks(candidates: List[str]) -> Dict[str, str]:
+    """
+    Возвращает блоки вида "{ID=<id>, TXT='<заменитель>'}" для кандидатов, признанных чувствительными.
+    Известные имена берутся из каталога, телефоны/email/соцсети принимаются без LLM, остальные
+    классифицируются одним запросом; новые записи добавляются в каталог.
+    """
+    by_name = _catalog_by_name()
+    found: Dict[str, Tuple[str, str]] = {}
+    new_names: List[str] = []
+    to_classify: List[str] = []
+    for cand in dict.fromkeys(candidates):
+        hit = by_name.get(cand)
+        if hit is not None:
+            found[cand] = hit
+            continue
+        category = _detect_category(cand)
+        if category in _HARD_CATEGORIES:
+            new_names.append(cand)
+        elif not _obviously_not_entity(cand, category):
+            to_classify.append(cand)
+
+    verdicts = await _classify_many(to_classify)
+    new_names.extend(cand for cand in to_classify if verdicts[cand])
+    if new_names:
+        # Блокировка каталога (в том числе межпроцессная) и запись файлов — вне event loop
+        found.update(await asyncio.to_thread(_insert_entities, new_names))
+    return {cand: f"{{ID={ne_id}, TXT='{placeholder}'}}" for cand, (ne_id, placeholder) in found.items()}
 
-    if not is_proper:
+
+async def is_sensitive_data(text: str) -> Tuple[bool, str]:
+    """
+    Определяет, относится ли входной текст к чувствительным данным (например, названия компаний,
+    продуктов, имена людей, географические названия). При положительном ответе добавляет или
+    извлекает запись из каталога и возвращает блок вида "{ID=<id>, TXT='<заменитель>'}".
+
+    :return: (is_proper: bool, block_or_empty: str)
+    """
+    candidate = text.strip()
+    if not candidate:
         return False, ""
 
-    new_id = str(uuid.uuid4())
-    placeholder = _generate_placeholder(candidate)
-    catalog[new_id] = {"name": candidate, "placeholder": placeholder}
-    _save_catalog(catalog)
-    return True, f"{{ID={new_id}, TXT='{placeholder}'}}"
+    block = (await _entity_blocks([candidate])).get(candidate)
+    if not block:
+        return False, ""
+    return True, block
 
 
 def add_sensitive_entity(name: str, placeholder: Optional[str] = None) -> str:
@@ -168,36 +594,159 @@ def add_sensitive_entity(name: str, placeholder: Optional[str] = None) -> str:
     if not clean_name:
         raise ValueError("Пустое значение невозможно добавить в справочник")
 
-    catalog = _load_catalog()
-    for ne_id, item in catalog.items():
-        if item.get("name") == clean_name:
+    with _catalog_lock():
+        hit = _catalog_by_name().get(clean_name)
+        if hit is not None:
+            ne_id = hit[0]
             if placeholder:
+                item = dict(_catalog_snapshot()[ne_id])
                 item["placeholder"] = placeholder.strip()
-                _save_catalog(catalog)
+                _append_catalog(ne_id, item)
             return ne_id
 
-    ne_id = str(uuid.uuid4())
-    final_placeholder = (placeholder or _generate_placeholder(clean_name)).strip()
-    catalog[ne_id] = {"name": clean_name, "placeholder": final_placeholder}
-    _save_catalog(catalog)
+        ne_id = _new_id()
+        final_placeholder = (placeholder or _generate_placeholder(clean_name)).strip()
+        _append_catalog(ne_id, {"name": clean_name, "placeholder": final_placeholder})
     return ne_id
 
 
+def update_sensitive_entity(ne_id: str, name: str, placeholder: str) -> bool:
+    """
+    Обновляет запись справочника. Возвращает False, если записи с таким ID нет.
+    """
+    with _catalog_lock():
+        if ne_id not in _catalog_snapshot():
+            return False
+        _append_catalog(ne_id, {"name": name, "placeholder": placeholder})
+    return True
+
+
+def delete_sensitive_entity(ne_id: str) -> bool:
+    """
+    Удаляет запись из справочника. Возвращает False, если записи с таким ID нет.
+    """
+    with _catalog_lock():
+        if ne_id not in _catalog_snapshot():
+            return False
+        _append_catalog(ne_id, None)
+    return True
+
+
+def _new_id() -> str:
+    # 12 символов base64url (72 бита случайности) вместо 36-символьного UUID: ID попадает
+    # в каждый блок маскированного текста
+    return secrets.token_urlsafe(9)
+
+
+def _insert_entities(names: List[str]) -> Dict[str, Tuple[str, str]]:
+    """
+    Добавляет в каталог новые записи и возвращает словарь имя -> (ID, заменитель). Записи
+    дописываются под одной блокировкой поверх актуальной версии каталога; имена, добавленные
+    другим запросом пока шёл запрос к LLM, повторно не добавляются.
+    """
+    result: Dict[str, Tuple[str, str]] = {}
+    rows: List[Tuple[str, Dict[str, str]]] = []
+    with _catalog_lock():
+        by_name = _catalog_by_name()
+        for name in names:
+            if name in result:
+                continue
+            hit = by_name.get(name)
+            if hit is None:
+                ne_id = _new_id()
+                placeholder = _generate_placeholder(name)
+                rows.append((ne_id, {"name": name, "placeholder": placeholder}))
+                hit = (ne_id, placeholder)
+            result[name] = hit
+        _append_catalog_many(rows)
+    return result
+
+
+def _catalog_by_upkey() -> Dict[str, Optional[str]]:
+    """
+    Возвращает индекс для простых блоков {ENTITY_NAME_1}: ключ — placeholder или имя в верхнем
+    регистре с "_" вместо пробелов, значение — имя записи. Ключи нормализуются один раз на версию
+    каталога; при совпадении побеждает первая запись.
+    """
+    catalog = _catalog_snapshot()
+    cached = _CATALOG_CACHE["by_upkey"]
+    if cached is not None and cached[0] is catalog:
+        return cached[1]
+    index: Dict[str, Optional[str]] = {}
+    for item in catalog.values():
+        name = item.get("name")
+        index.setdefault(item.get("placeholder", "").upper().replace(" ", "_"), name)
+        index.setdefault((name or "").upper().replace(" ", "_"), name)
+    _CATALOG_CACHE["by_upkey"] = (catalog, index)
+    return index
+
+
+def _trie_pattern(names: List[str]) -> str:
+    """
+    Строит регулярное выражение по префиксному дереву имён: общие префиксы записываются один раз,
+    поэтому в каждой позиции текста движок проверяет не все имена, а один путь по дереву.
+    Продолжение имени пробуется раньше его окончания — находится самое длинное имя.
+    """
+    trie: Dict[str, Any] = {}
+    for name in names:
+        node = trie
+        for ch in name:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def _emit(node: Dict[str, Any]) -> str:
+        parts = []
+        for ch, child in node.items():
+            if not ch:
+                continue
+            label = ch
+            # Цепочку без ветвлений записываем одной строкой
+            while len(child) == 1 and "" not in child:
+                (next_ch, child), = child.items()
+                label += next_ch
+            parts.append(re.escape(label) + _emit(child))
+        if not parts:
+            return ""
+        body = "|".join(parts)
+        if "" in node:
+            return f"(?:{body})?"
+        return body if len(parts) == 1 else f"(?:{body})"
+
+    return _emit(trie)
+
+
+def _catalog_matcher() -> Tuple[Optional[Pattern[str]], Dict[str, str]]:
+    """
+    Возвращает единый паттерн по всем именам каталога (самое длинное имя в позиции побеждает)
+    и словарь имя -> блок {ID=<id>, TXT='<заменитель>'}. Строится один раз на версию каталога.
+    """
+    catalog = _catalog_snapshot()
+    matcher = _CATALOG_CACHE.get("matcher")
+    if matcher is None or matcher[0] is not catalog:
+        blocks: Dict[str, str] = {}
+        for ne_id, item in catalog.items():
+            name_value = item.get("name")
+            if name_value and name_value not in blocks:
+                blocks[name_value] = f"{{ID={ne_id}, TXT='{item.get('placeholder', '')}'}}"
+        pattern = None
+        if blocks:
+            pattern = re.compile(_trie_pattern(list(blocks)))
+        matcher = (catalog, pattern, blocks)
+        _CATALOG_CACHE["matcher"] = matcher
+    return matcher[1], matcher[2]
+
+
 def mask_by_catalog(text: str) -> str:
     """
     Заменяет все вхождения известных из каталога чувствительных данных на блоки вида
-    {ID=<id>, TXT='<заменитель>'}. Точная замена по исходной форме.
+    {ID=<id>, TXT='<заменитель>'}. Точная замена по исходной форме за один проход по тексту.
     """
     if not text:
         return text
-    catalog = _load_catalog()
-    entries = sorted(((item["name"], ne_id, item["placeholder"]) for ne_id, item in catalog.items()), key=lambda x: len(x[0]), reverse=True)
-    masked = text
-    for name_value, ne_id, placeholder in entries:
-        if not name_value:
-            continue
-        masked = re.sub(re.escape(name_value), f"{{ID={ne_id}, TXT='{placeholder}'}}", masked)
-    return masked
+    pattern, blocks = _catalog_matcher()
+    if pattern is None:
+        return text
+    return pattern.sub(lambda m: blocks[m.group(0)], text)
 
 
 async def mask_with_catalog_then_llm(text: str) -> str:
@@ -205,35 +754,46 @@ async def mask_with_catalog_then_llm(text: str) -> str:
     return await mask_sensitive_data_in_text(pre_masked)
 
 
-async def mask_sensitive_data_in_text(text: str) -> str:
-    if not text.strip():
-        return text
-
-    # 1) Разбиваем вход на сегменты: уже замещённые блоки и обычный текст
-    segments: List[Tuple[str, str]] = []  # (type, content) где type in {"block", "plain"}
+def _iter_plain_with_candidates(text: str) -> Iterator[Tuple[str, str, Set[str]]]:
+    """
+    Разбивает текст на уже замещённые блоки и обычный текст за один проход и для обычного текста
+    сразу находит email, телефоны и ссылки на соцсети. Выдаёт (тип, содержимое, кандидаты),
+    где тип — "block" или "plain".
+    """
     last_index = 0
     for m in BLOCK_SPAN_PATTERN.finditer(text):
         start, end = m.start(), m.end()
         if start > last_index:
-            segments.append(("plain", text[last_index:start]))
-        segments.append(("block", m.group(0)))
+            plain = text[last_index:start]
+            yield "plain", plain, _extract_sensitive_patterns(plain)
+        yield "block", m.group(0), set()
         last_index = end
     if last_index < len(text):
-        segments.append(("plain", text[last_index:]))
+        plain = text[last_index:]
+        yield "plain", plain, _extract_sensitive_patterns(plain)
+
 
-    # 2) Собираем только незамещённые части для поиска кандидатов
+async def mask_sensitive_data_in_text(text: str) -> str:
+    if not text.strip():
+        return text
+
+    # 1) Разбиваем вход на сегменты и сразу собираем кандидатов по паттернам (email/phone/social)
+    segments: List[Tuple[str, str]] = []  # (type, content) где type in {"block", "plain"}
+    pattern_candidates: Set[str] = set()
+    for typ, content, found in _iter_plain_with_candidates(text):
+        segments.append((typ, content))
+        pattern_candidates |= found
+
+    # 2) Собираем только незамещённые части для запроса к LLM
     plain_text = "".join(content for typ, content in segments if typ == "plain")
     if not plain_text.strip():
         return text
 
-    # Кандидаты по паттернам (email/phone/social)
-    pattern_candidates = _extract_sensitive_patterns(plain_text)
-
     system_prompt = (
         "Ты выделяешь возможные чувствительные данные (компании, продукты, люди, организации, телефоны, email, аккаунты/ссылки соцсетей) в тексте. "
         "Верни строго JSON массив уникальных точных фрагментов из текста (без изменений регистра), например: [\"Иван Иванов\", \"ООО Ромашка\"]."
     )
-    raw = await ollama_answer(
+    raw = await _llm_answer(
         question=f"Текст:\n{plain_text}\nВыдели чувствительные данные и верни только JSON массив строк.",
         system_prompt=system_prompt,
     )
@@ -246,24 +806,36 @@ async def mask_sensitive_data_in_text(text: str) -> str:
     except Exception:
         candidates = list({m.group(0) for m in re.finditer(r"[A-ZА-ЯЁ][\w\-]+(?:\s+[A-ZА-ЯЁ][\w\-]+)+", plain_text)})
 
-    # Объединяем кандидатов с шаблонными и сортируем по длине (длинные сначала)
-    all_candidates = sorted(set(candidates).union(pattern_candidates), key=len, reverse=True)
+    # Объединяем кандидатов с шаблонными и приводим к канонической форме (без крайних пробелов,
+    # внутренние пробелы схлопнуты): варианты одной фразы классифицируются один раз, а в тексте
+    # заменяется каждый из них. Порядок детерминированный (длинные сначала, затем по алфавиту),
+    # чтобы одинаковый текст давал одинаковый запрос к LLM и попадал в кэш
+    canonical = {cand: " ".join(cand.split()) for cand in set(candidates).union(pattern_candidates)}
+    all_candidates = sorted({canon for canon in canonical.values() if canon}, key=lambda c: (-len(c), c))
+
+    # 3) Классифицируем всех кандидатов разом и выполняем замену только в plain-сегментах,
+    # блоки не трогаем
+    blocks = await _entity_blocks(all_candidates)
+    replacements = {cand: blocks[canon] for cand, canon in canonical.items() if canon in blocks}
+    if not replacements:
+        return text
 
-    # 3) Выполняем замену только в plain-сегментах, блоки не трогаем
-    for cand in all_candidates:
-        ok, block = await is_sensitive_data(cand)
-        if not (ok and block):
-            continue
-        pattern = re.escape(cand)
-        updated_segments: List[Tuple[str, str]] = []
-        for typ, content in segments:
-            if typ == "plain" and content:
-                content = re.sub(pattern, block, content)
-            updated_segments.append((typ, content))
-        segments = updated_segments
+    if len(replacements) == 1:
+        # Один кандидат — обычная замена подстроки, регулярное выражение не нужно
+        (cand, block), = replacements.items()
+
+        def _replace(content: str) -> str:
+            return content.replace(cand, block)
+    else:
+        # Один проход по каждому сегменту сразу для всех кандидатов (самый длинный в позиции
+        # побеждает); вставленные блоки повторно не просматриваются
+        pattern = re.compile(_trie_pattern(list(replacements)))
+
+        def _replace(content: str) -> str:
+            return pattern.sub(lambda m: replacements[m.group(0)], content)
 
     # 4) Склеиваем сегменты обратно
-    return "".join(content for _, content in segments)
+    return "".join(_replace(content) if typ == "plain" else content for typ, content in segments)
 
 
 async def call_openrouter_with_masked_text(masked_text: str, system_prompt: str) -> str:
@@ -275,31 +847,21 @@ def demask_text(text_with_blocks: str) -> str:
     if not text_with_blocks:
         return text_with_blocks
 
-    catalog = _load_catalog()
-
-    def _replace_detailed(match: re.Match) -> str:
-        ne_id = match.group("id")
-        item = catalog.get(ne_id)
-        if not item:
-            return match.group(0)
-        return item.get("name", match.group(0))
-
-    def _replace_simple(match: re.Match) -> str:
-        entity_name = match.group("entity")
-        # Ищем в каталоге по placeholder'у или имени
-        for entity_id, item in catalog.items():
-            if (item.get("placeholder", "").upper().replace(" ", "_") == entity_name or
-                item.get("name", "").upper().replace(" ", "_") == entity_name):
-                return item.get("name", match.group(0))
-        return match.group(0)
-
-    # Сначала обрабатываем детальные блоки {ID=..., TXT="..."}
-    result = BLOCK_PATTERN.sub(_replace_detailed, text_with_blocks)
-    
-    # Затем обрабатываем простые блоки {ENTITY_NAME_1}
-    result = SIMPLE_BLOCK_PATTERN.sub(_replace_simple, result)
-    
-    return result
+    catalog = _catalog_snapshot()
+    by_upkey = _catalog_by_upkey()
+
+    def _replace(match: re.Match) -> str:
+        if match.lastgroup == "detailed":
+            # Детальные блоки {ID=..., TXT="..."}
+            item = catalog.get(match.group("id"))
+            if not item:
+                return match.group(0)
+            return item.get("name", match.group(0))
+        # Простые блоки {ENTITY_NAME_1}: ищем в каталоге по placeholder'у или имени
+        name = by_upkey.get(match.group("entity"))
+        return name if name is not None else match.group(0)
+
+    return _DEMASK_RE.sub(_replace, text_with_blocks)
 
 
 def replace_blocks_with_placeholder(text: str) -> str:
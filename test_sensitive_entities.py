@@ -0,0 +1,47 @@
+"""
+Регрессионные тесты поиска email/телефонов/ссылок в sensitive_entities.
+Запуск: python -m unittest test_sensitive_entities
+"""
+
+import time
+import unittest
+
+from sensitive_entities import _extract_sensitive_patterns
+
+
+class ExtractSensitivePatternsTest(unittest.TestCase):
+    def test_email_scan_is_linear_on_long_dotted_runs(self):
+        # Раньше попытки с каждой границы слова давали квадратичное время (~2.4 с на 40 КБ)
+        start = time.perf_counter()
+        self.assertEqual(_extract_sensitive_patterns("a." * 20000), set())
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    def test_email_glued_to_word_by_dot_or_dash_is_found(self):
+        self.assertEqual(_extract_sensitive_patterns("см.ivan@mail.ru"), {"ivan@mail.ru"})
+        self.assertEqual(_extract_sensitive_patterns("Иванов-ivan@mail.ru"), {"ivan@mail.ru"})
+        self.assertEqual(_extract_sensitive_patterns("ООО-Ромашка-info@romashka.ru"), {"info@romashka.ru"})
+
+    def test_email_with_leading_punctuation(self):
+        self.assertEqual(_extract_sensitive_patterns("..john.doe@mail.ru,"), {"john.doe@mail.ru"})
+        self.assertEqual(_extract_sensitive_patterns("(ivan@mail.ru)"), {"ivan@mail.ru"})
+
+    def test_long_number_run_is_not_split_into_phones(self):
+        # Обрывок серии чисел длиннее 60 символов не должен приниматься за телефон
+        self.assertEqual(_extract_sensitive_patterns("Итого: " + "1234 " * 15), set())
+
+    def test_phones_are_found_without_surrounding_whitespace(self):
+        self.assertEqual(
+            _extract_sensitive_patterns("Звоните +7 (999) 123-45-67, или 8 800 555 35 35."),
+            {"+7 (999) 123-45-67", "8 800 555 35 35."},
+        )
+        self.assertEqual(_extract_sensitive_patterns("тел: (999) 123-45-67"), {"(999) 123-45-67"})
+
+    def test_phone_scan_is_linear_on_long_runs(self):
+        start = time.perf_counter()
+        for text in (" " * 100000, "1 " * 50000, "- " * 50000):
+            self.assertEqual(_extract_sensitive_patterns(text), set())
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()